@@ -1,112 +1,258 @@
 import os
+import re
 import json
 import click
+from multiprocessing import Pool
 from lxml import etree
-from collections import Counter, defaultdict
-from typing import Dict, Counter as CounterType, List, Tuple, Optional
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from functools import lru_cache
+from typing import Dict, Counter as CounterType, List, Tuple, Optional, Type, Iterator, DefaultDict, IO, Union
 from tabulate import tabulate
 from unicodedata import normalize
 
 UNKNOWN_SEGMENT_TYPE = "Not specified"
+# Captures MYTAG in PAGE @custom values such as "structure {type:MYTAG ;}"
+_CUSTOM_TYPE = re.compile(r"structure\s*\{type:([^;}]*)")
 
+# Options of the XML parser: ids and blank text are never read by the counters,
+# while huge_tree lifts libxml2 limits that large pages can hit.
+# Entities must stay resolved: parser targets would otherwise receive "&amp;" as "&#38;" in attributes
+_PARSER_OPTIONS = dict(collect_ids=False, remove_blank_text=True, huge_tree=True)
 
+ALTO4_NS = "http://www.loc.gov/standards/alto/ns-v4#"
+
+# Qualified tag names (Clark notation), compared as plain strings without any prefix resolution
+ALTO4_OTHERTAG = "{%s}OtherTag" % ALTO4_NS
+ALTO4_TEXTBLOCK = "{%s}TextBlock" % ALTO4_NS
+ALTO4_TEXTLINE = "{%s}TextLine" % ALTO4_NS
+ALTO4_STRING = "{%s}String" % ALTO4_NS
+
+
+@lru_cache(maxsize=None)
+def _local_name(tag: str) -> str:
+    # Cached: a document only holds a handful of distinct qualified tags
+    return tag.rpartition("}")[2]
+
+
+# performance: the work here is reading XML attributes and text, and counting Python strings.
+# Numba would fall back to object mode on such string workloads and end up slower than plain Python,
+# so do not add @numba.jit here: speed comes from lxml's C parser and from keeping the per-element callbacks short.
 class Parser:
-    def __init__(self, normalization: Optional[str] = None):
+    """ Parsers are used as lxml parser targets: lxml calls their start() method (and end() and data()
+    when a subclass defines them) while reading, so no element object is ever built
+    """
+    def __init__(self, normalization: Optional[str] = None, char_types: bool = True):
         self.lines: Dict[str, int] = Counter()
         self.chars: Dict[str, int] = Counter()
         self.regions: Dict[str, int] = Counter()
+        self.n_chars: int = 0
         self._normalization: Optional[str] = normalization
+        self._char_types: bool = char_types
+        self._texts: List[str] = []
 
     def normalize(self, string: str) -> str:
         if self._normalization:
             return normalize(self._normalization, string)
         return string
 
-    def get_lines(self, xml: etree.ElementTree) -> Dict[str, int]:
-        raise NotImplementedError
-
-    def get_chars(self, xml: etree.ElementTree) -> Dict[str, int]:
-        raise NotImplementedError
-
-    def get_regions(self, xml: etree.ElementTree) -> Dict[str, int]:
+    def get_lines(self) -> CounterType[str]:
+        return self.lines
+
+    def get_chars(self) -> CounterType[str]:
+        return self.chars
+
+    def get_regions(self) -> CounterType[str]:
+        return self.regions
+
+    def extract_all(
+            self, filepath: Union[str, IO[bytes]]
+    ) -> Tuple[CounterType[str], CounterType[str], CounterType[str]]:
+        """ Count lines, chars and regions of a file in one pass """
+        self.parse(filepath)
+        return self.lines, self.chars, self.regions
+
+    def parse(self, filepath: Union[str, IO[bytes]]) -> None:
+        # Single streaming pass filling the counters of the current file
+        self.lines, self.regions = Counter(), Counter()
+        self._texts = []
+        # Target parsers swallow I/O errors on file names: files are opened here so that a wrong path raises
+        if isinstance(filepath, str):
+            with open(filepath, "rb") as f:
+                etree.parse(f, etree.XMLParser(target=self, **_PARSER_OPTIONS))
+        else:
+            etree.parse(filepath, etree.XMLParser(target=self, **_PARSER_OPTIONS))
+
+    def start(self, tag: str, attrib: Dict[str, str]) -> None:
         raise NotImplementedError
 
-    def parse(self, filepath: str) -> etree.ElementTree:
-        raise NotImplementedError
+    def close(self) -> None:
+        # Called by lxml once the document is read
+        self.chars, self.n_chars = self._count_chars(self._texts)
+
+    def _count_chars(self, texts: List[str]) -> Tuple[CounterType[str], int]:
+        # Texts are normalized and counted once per document. "\n" cannot compose with its neighbours,
+        # so joining on it gives the same normalization as handling each text on its own.
+        text = self.normalize("\n".join(texts)).replace(" ", "")
+        separators = max(len(texts) - 1, 0)
+        total = len(text) - separators
+        if not self._char_types:
+            # Only the total is needed, the per-character count is skipped
+            return Counter(), total
+        chars = Counter(text)
+        newlines = chars.pop("\n", 0) - separators
+        if newlines:
+            chars["\n"] = newlines
+        return chars, total
 
 
 class Alto4Parser(Parser):
-    def __init__(self, normalization: Optional[str] = None):
-        super(Alto4Parser, self).__init__(normalization)
-        self._ns = {"a": "http://www.loc.gov/standards/alto/ns-v4#"}
+    def __init__(self, normalization: Optional[str] = None, char_types: bool = True):
+        super(Alto4Parser, self).__init__(normalization, char_types)
         self._labels: Dict[str, str] = {}
 
-    def parse(self, filepath: str) -> etree.ElementTree:
-        xml = etree.parse(filepath)
-        self._labels = {
-            node.attrib["ID"]: node.attrib["LABEL"]
-            for node in xml.xpath("//a:OtherTag", namespaces=self._ns)
-        }
-        return xml
-
-    def get_lines(self, xml: etree.ElementTree) -> CounterType[str]:
-        return Counter([
-            self._labels.get(line.attrib.get("TAGREFS", "####"), UNKNOWN_SEGMENT_TYPE)
-            for line in xml.xpath("//a:TextLine", namespaces=self._ns)
-        ])
+    def parse(self, filepath: Union[str, IO[bytes]]) -> None:
+        self._labels = {}
+        super(Alto4Parser, self).parse(filepath)
 
-    def get_chars(self, xml: etree.ElementTree) -> CounterType[str]:
-        return Counter("".join([
-            self.normalize(str(line))
-            for line in xml.xpath("//a:TextLine/a:String/@CONTENT", namespaces=self._ns)
-        ]).replace(" ", ""))
-
-    def get_regions(self, xml: etree.ElementTree) -> CounterType[str]:
-        return Counter([
-            self._labels.get(line.attrib.get("TAGREFS", "####"), UNKNOWN_SEGMENT_TYPE)
-            for line in xml.xpath("//a:TextBlock", namespaces=self._ns)
-        ])
+    def start(self, tag: str, attrib: Dict[str, str]) -> None:
+        if tag == ALTO4_STRING:
+            content = attrib.get("CONTENT")
+            if content:
+                self._texts.append(content)
+        elif tag == ALTO4_TEXTLINE:
+            self.lines[self._labels.get(attrib.get("TAGREFS"), UNKNOWN_SEGMENT_TYPE)] += 1
+        elif tag == ALTO4_TEXTBLOCK:
+            self.regions[self._labels.get(attrib.get("TAGREFS"), UNKNOWN_SEGMENT_TYPE)] += 1
+        elif tag == ALTO4_OTHERTAG:
+            # <Tags> comes before <Layout> in ALTO, so labels are known before any line or block
+            self._labels[attrib["ID"]] = attrib["LABEL"]
 
 
 class Page2019Parser(Parser):
-    def __init__(self, normalization: Optional[str] = None):
-        super(Page2019Parser, self).__init__(normalization)
-        self._ns = {"p": "http://schema.primaresearch.org/PAGE/gts/pagecontent/2019-07-15"}
-        self._labels: Dict[str, str] = {}
-
-    def parse(self, filepath: str) -> etree.ElementTree:
-        # TODO: There's no equivalent to alto's //OtherTag in PAGEXML
-        xml = etree.parse(filepath)
-        return xml
-
-    def get_lines(self, xml: etree.ElementTree) -> CounterType[str]:
-        return Counter([
-            self._handle_custom_type(line.attrib.get("custom", UNKNOWN_SEGMENT_TYPE))
-            for line in xml.findall("//{*}TextLine", namespaces=self._ns)
-        ])
-
-    def get_chars(self, xml: etree.ElementTree) -> CounterType[str]:
-        return Counter("".join([
-            self.normalize(str(line.text))
-            for line in xml.findall("//{*}TextLine/{*}TextEquiv/{*}Unicode", namespaces=self._ns)
-        ]).replace(" ", ""))
-
-    def get_regions(self, xml: etree.ElementTree) -> CounterType[str]:
-        return Counter([
-            self._handle_custom_type(line.attrib.get("custom", UNKNOWN_SEGMENT_TYPE))
-            for line in xml.findall("//{*}TextRegion", namespaces=self._ns)
-        ])
+    def __init__(self, normalization: Optional[str] = None, char_types: bool = True):
+        super(Page2019Parser, self).__init__(normalization, char_types)
+        self._path: List[str] = []
+        self._text: Optional[List[str]] = None
+
+    def parse(self, filepath: Union[str, IO[bytes]]) -> None:
+        self._path, self._text = [], None
+        super(Page2019Parser, self).parse(filepath)
+
+    def start(self, tag: str, attrib: Dict[str, str]) -> None:
+        # Tags are compared on their local name, so that other PAGE schema versions keep working
+        name = _local_name(tag)
+        if name == "Unicode":
+            # Only line-level transcriptions are counted, not the ones of regions or words
+            if self._path[-2:] == ["TextLine", "TextEquiv"]:
+                self._text = []
+        elif name == "TextLine":
+            self.lines[self._handle_custom_type(attrib.get("custom", UNKNOWN_SEGMENT_TYPE))] += 1
+        elif name == "TextRegion":
+            self.regions[self._handle_custom_type(attrib.get("custom", UNKNOWN_SEGMENT_TYPE))] += 1
+        self._path.append(name)
+
+    def data(self, data: str) -> None:
+        if self._text is not None:
+            self._text.append(data)
+
+    def end(self, tag: str) -> None:
+        self._path.pop()
+        if self._text is not None:
+            text = "".join(self._text)
+            if text:
+                self._texts.append(text)
+            self._text = None
 
     @staticmethod
+    @lru_cache(maxsize=1024)
     def _handle_custom_type(value: str) -> str:
         # there's no equivalent to TAGREFS in PAGEXML
         # eScriptorium stores this info in @custom with value formed such as:
         # custom="structure {type:MYTAG ;}"
-        return value.replace("structure {type:", "").replace(";}", "").strip()
+        match = _CUSTOM_TYPE.search(value)
+        if match:
+            return match.group(1).strip()
+        return value.strip()
+
+
+# Reading ahead of the parser when files are processed in a single process
+PREFETCH_THREADS = 4
+PREFETCH_FILES = 8
+
+# (directory, lines, chars, regions, number of chars) of a file
+FileCounts = Tuple[str, CounterType[str], CounterType[str], CounterType[str], int]
+
+PARSERS: Dict[str, Type[Parser]] = {
+    "alto": Alto4Parser,
+    "page": Page2019Parser
+}
+
+
+def _process_file(
+        job: Tuple[str, str, Optional[str], bool],
+        source: Optional[IO[bytes]] = None
+) -> FileCounts:
+    # Top-level function so that it can be sent to worker processes
+    file_name, parse, normalization, char_types = job
+    parser = PARSERS[parse](normalization=normalization, char_types=char_types)
+    try:
+        l, c, r = parser.extract_all(source if source is not None else file_name)
+    except etree.XMLSyntaxError as err:
+        # lxml errors cannot be pickled back from worker processes: report them with the file name instead
+        raise click.ClickException(f"{file_name}: {err}")
+    return os.path.dirname(file_name), l, c, r, parser.n_chars
+
+
+def _read_file(file_name: str) -> IO[bytes]:
+    with open(file_name, "rb") as f:
+        buffer = BytesIO(f.read())
+    # lxml reads the name of file objects, which keeps the real path in parse errors
+    buffer.name = file_name
+    return buffer
+
+
+def _process_prefetched(
+        jobs: List[Tuple[str, str, Optional[str], bool]]
+) -> Iterator[FileCounts]:
+    # Files ahead are read by threads while the current one is parsed, which hides slow disks (NFS, mounts)
+    with ThreadPoolExecutor(max_workers=PREFETCH_THREADS) as executor:
+        window = deque()
+        for job in jobs:
+            window.append((job, executor.submit(_read_file, job[0])))
+            if len(window) > PREFETCH_FILES:
+                job, future = window.popleft()
+                yield _process_file(job, future.result())
+        for job, future in window:
+            yield _process_file(job, future.result())
+
+
+def process_files(
+        files: List[str], parse: str, normalization: Optional[str] = None, workers: int = 1,
+        char_types: bool = True
+) -> Iterator[FileCounts]:
+    """ Yield (directory, lines, chars, regions, number of chars) for each file, in the order of `files`
+
+    When `char_types` is False, chars are not counted per character and stay empty
+    """
+    jobs = [(file_name, parse, normalization, char_types) for file_name in files]
+    if len(jobs) <= 1:
+        yield from map(_process_file, jobs)
+    elif workers <= 1:
+        yield from _process_prefetched(jobs)
+    else:
+        with Pool(min(workers, len(jobs))) as pool:
+            yield from pool.imap(_process_file, jobs, chunksize=max(1, len(jobs) // (workers * 4)))
+
+
+def add_counts(total: DefaultDict[str, int], counts: Dict[str, int]) -> None:
+    for key, count in counts.items():
+        total[key] += count
 
 
 def sort_counter(counter: CounterType[str], item_place: int = 1) -> List[Tuple[str, int]]:
-    return sorted(list(counter.items()), key=lambda x: x[item_place], reverse=True)
+    return sorted(counter.items(), key=lambda x: x[item_place], reverse=True)
 
 
 def print_counter(counter: CounterType[str], category: str) -> None:
@@ -124,27 +270,21 @@ def show_title(title):
     click.echo()
 
 
-def print_counter_group(counters: Dict[str, CounterType[str]], category: str) -> None:
+def print_total_group(totals: Dict[str, int]) -> None:
+    print(tabulate(
+        list(totals.items()),
+        headers=["Directory", "Count"],
+        tablefmt="pipe"
+    ))
+
+
+def print_counter_group(counters: Dict[str, Dict[str, int]], category: str) -> None:
     table = []
     total = 0
-    # In case we don't have a category, we merge subcategories
-    if category is None:
-        for directory, counter in counters.items():
-            table.append((directory, sum(counter.values())))
-        print(tabulate(
-            table,
-            headers=["Directory", "Count"],
-            tablefmt="pipe"
-        ))
-        return
-
     for directory, counter in counters.items():
-        cnter = sort_counter(counter, 0)  # We sort per category here
-        for idx, (key, cnt) in enumerate(cnter):
-            if idx == 0:
-                table.append((directory, key, cnt))
-            else:
-                table.append(("", key, cnt))
+        # We sort per category here, alphabetically
+        for idx, (key, cnt) in enumerate(sorted(counter.items())):
+            table.append((directory if idx == 0 else "", key, cnt))
         total += sum(counter.values())
     table.append(["-----", "-----", "-----"])
     table.append(["All", "All", total])
@@ -169,41 +309,48 @@ def separator():
 @click.option("--parse", type=click.Choice(["alto", "page"]), default="alto")
 @click.option("--github-envs", default=False, is_flag=True)
 @click.option("--to-json", type=click.File("w"), default=None)
+@click.option("-j", "--workers", type=click.IntRange(min=1), default=None,
+              help="Number of processes used to parse files [default: number of CPUs]")
 def run(files, chars: bool = False, group: bool = False, parse: str = "alto", github_envs: bool = False,
-        to_json: Optional[click.File] = None, normalization: Optional[str] = None):
+        to_json: Optional[click.File] = None, normalization: Optional[str] = None, workers: Optional[int] = None):
 
     if normalization:
         normalization = normalization.upper()
 
-    parser: Parser = None
-    if parse == "alto":
-        parser = Alto4Parser(normalization=normalization)
-    elif parse == "page":
-        parser = Page2019Parser(normalization=normalization)
+    if workers is None:
+        workers = os.cpu_count() or 1
 
-    total_chars = Counter()
-    total_lines = Counter()
-    total_regns = Counter()
+    # Plain dicts are cheaper than Counter.update() while merging, they become Counters once all files are read
+    total_chars = defaultdict(int)
+    total_lines = defaultdict(int)
+    total_regns = defaultdict(int)
 
     if group:
-        group_chars = defaultdict(Counter)
-        group_lines = defaultdict(Counter)
-        group_regns = defaultdict(Counter)
-
-    for file_name in files:
-        xml = parser.parse(file_name)
-        l, c, r = parser.get_lines(xml), parser.get_chars(xml), parser.get_regions(xml)
+        group_chars = defaultdict(int)
+        group_lines = defaultdict(lambda: defaultdict(int))
+        group_regns = defaultdict(lambda: defaultdict(int))
+
+    # Character types are only displayed with --chars, other outputs only need the total
+    n_chars = 0
+    for dirname, l, c, r, n_c in process_files(files, parse, normalization=normalization, workers=workers,
+                                               char_types=chars):
         # Update groups
         if group:
-            dirname = os.path.dirname(file_name)
-            group_chars[dirname].update(c)
-            group_lines[dirname].update(l)
-            group_regns[dirname].update(r)
+            group_chars[dirname] += n_c
+            add_counts(group_lines[dirname], l)
+            add_counts(group_regns[dirname], r)
 
         # Update global
-        total_chars.update(c)
-        total_lines.update(l)
-        total_regns.update(r)
+        add_counts(total_chars, c)
+        n_chars += n_c
+        add_counts(total_lines, l)
+        add_counts(total_regns, r)
+
+    total_chars, total_lines, total_regns = Counter(total_chars), Counter(total_lines), Counter(total_regns)
+
+    n_lines = sum(total_lines.values())
+    n_regns = sum(total_regns.values())
+    n_files = len(files)
 
     show_title("Lines (All)")
     print_counter(total_lines, "Line type")
@@ -226,30 +373,35 @@ def run(files, chars: bool = False, group: bool = False, parse: str = "alto", gi
         print_counter_group(group_regns, "Region type")
         separator()
         show_title("Chars (Directory)")
-        print_counter_group(group_chars, None)
+        print_total_group(group_chars)
         separator()
 
     show_title("Yaml Cataloging Details for HTR United")
-    click.secho("""volume:
-    - {count: """ + str(sum(total_lines.values())) + """, metric: "lines"}
-    - {count: """ + str(len(files)) + """, metric: "files"}
-    - {count: """ + str(sum(total_regns.values())) + """, metric: "regions"}
-    - {count: """ + str(sum(total_chars.values())) + """, metric: "characters"}""", color=True, fg="blue")
+    click.secho(
+        "volume:\n"
+        f'    - {{count: {n_lines}, metric: "lines"}}\n'
+        f'    - {{count: {n_files}, metric: "files"}}\n'
+        f'    - {{count: {n_regns}, metric: "regions"}}\n'
+        f'    - {{count: {n_chars}, metric: "characters"}}',
+        color=True, fg="blue"
+    )
 
     if github_envs:
         with open("envs.txt", "w") as f:
-            f.write(f"HTRUNITED_LINES={str(sum(total_lines.values()))}\n")
-            f.write(f"HTRUNITED_REGNS={str(sum(total_regns.values()))}\n")
-            f.write(f"HTRUNITED_CHARS={str(sum(total_chars.values()))}\n")
-            f.write(f"HTRUNITED_FILES={len(files)}\n")
+            f.write(
+                f"HTRUNITED_LINES={n_lines}\n"
+                f"HTRUNITED_REGNS={n_regns}\n"
+                f"HTRUNITED_CHARS={n_chars}\n"
+                f"HTRUNITED_FILES={n_files}\n"
+            )
     if to_json is not None:
         # chars as keys from total_chars
         volume = {
             "volume": [
-                {"metric": "lines", "count": sum(total_lines.values())},
-                {"metric": "files", "count": len(files)},
-                {"metric": "regions", "count": sum(total_regns.values())},
-                {"metric": "characters", "count": sum(total_chars.values())}
+                {"metric": "lines", "count": n_lines},
+                {"metric": "files", "count": n_files},
+                {"metric": "regions", "count": n_regns},
+                {"metric": "characters", "count": n_chars}
             ]
         }
         characters = {}
@@ -257,7 +409,7 @@ def run(files, chars: bool = False, group: bool = False, parse: str = "alto", gi
             characters = {
                 "characters": {
                     "mode": "None" if not normalization else normalization,
-                    "members": list(dict(sort_counter(total_chars)).keys())
+                    "members": [char for char, _ in sort_counter(total_chars)]
                 }
             }
         json.dump(